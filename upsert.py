@@ -1,12 +1,103 @@
+import hashlib
+import operator
+from collections import defaultdict, namedtuple
+from decimal import Decimal, InvalidOperation
 import psycopg2
+import random
+import time
+import weakref
 
-to_tup = lambda dct, k: tuple([dct[x] for x in k])
+# a current row matched to an upsert row, by indexes, on key
+Update = namedtuple("Update", "key current upsert")
+
+def to_getter(fields):
+    """ return a function collecting fields from a row as a tuple """
+    get = operator.itemgetter(*fields)
+    if len(fields) == 1:
+        return lambda row: (get(row),)
+    return get
+
+# stands in for db.sql() on dryrun
+print_sql = lambda query, args=(): print(query, args)
+
+# rows per batched statement
+PAGE_SIZE = 1000
+
+# key indexes ensured per db
+ensured = {}
+
+# names of statements prepared per db
+prepared = {}
+
+def to_int(val):
+    """ cast to int without dropping a fractional part """
+    new = int(val)
+    if not isinstance(val, str) and new != val:
+        raise ValueError(f"{val} is not integral")
+    return new
+
+def to_str(val):
+    """ cast scalars to their text as postgres would on assignment, containers and bytes have none """
+    if isinstance(val, (bytes, bytearray, memoryview, list, tuple, dict, set)):
+        raise TypeError(f"{val} is not a scalar")
+    if isinstance(val, bool):
+        return "true" if val else "false"
+    return str(val)
+
+# python types for postgres types, upsert values are cast to these before comparing
+casts = {
+    "smallint": to_int,
+    "integer": to_int,
+    "bigint": to_int,
+    "numeric": lambda x: x if isinstance(x, Decimal) else Decimal(str(x)),
+    "real": float,
+    "double precision": float,
+    "text": to_str,
+    "character varying": to_str,
+    "bpchar": to_str,
+}
+
+# types without an equality operator, compared as text
+no_equality = { "json", "xml", "point", "path", "polygon" }
+
+def get_cached(cache, db, default):
+    """ return the entry for db in a cache keyed by id(db), dropped when db is collected """
+    key = id(db)
+    if key not in cache:
+        try:
+            weakref.finalize(db, cache.pop, key, None)
+        except TypeError:
+            # db can't be weakly referenced, so nothing is cached for it
+            return default()
+        cache[key] = default()
+    return cache[key]
+
+# fields and types per db and table
+schemas = {}
+
+def get_schema(db, table):
+    """ return the fields of a table and a map of fields to postgres types, cached per db """
+    tables = get_cached(schemas, db, dict)
+    if table not in tables:
+        # typmod -1 names the base type, e.g. bpchar for character(3), casts to it don't truncate or round
+        rows = db.get(f"SELECT attname, format_type(atttypid, -1) AS type FROM pg_attribute WHERE attrelid = '{table}'::regclass AND attnum > 0 AND NOT attisdropped")
+        tables[table] = { "fields": tuple(db.get_fields(table)), "types": { row["attname"]: row["type"] for row in rows } }
+    return tables[table]
+
+def clear_schema(db, table=None):
+    """ drop cached fields and types for a table, or all tables, after altering them """
+    tables = schemas.get(id(db), {})
+    if table is None:
+        tables.clear()
+    else:
+        tables.pop(table, None)
 
 """ 
 args
 ----
 db : db
-  database class with methods get(), get_fields(), sql(), and insert()
+  database class with methods get(), get_fields(), and sql(), and optionally
+  acquire(), a context manager yielding the same from one pooled connection
 table : str
   table name as string
 keys : list
@@ -40,6 +131,27 @@ kwargs
     dict of key mappings to make on match 
   dryrun : bool
     print planned database operations to stdout
+  strict_types : bool
+    raise on python type mismatches with current values instead of casting to column types, casts are written into the upsert dicts as defaults are
+  prepare : bool
+    run updates as server-side prepared statements, db.sql() must share one connection
+  ensure_index : bool
+    create an index on each key unless one leads with its fields, put the most selective fields first in keys,
+    the index isn't unique, so it doesn't serve bulk, and CREATE INDEX blocks writes to the table until it is built
+  index_kind : str
+    "hash" for hash indexes on single field keys, otherwise btree
+  bulk : bool
+    upsert server-side with ON CONFLICT DO UPDATE when possible, requires a unique index on the key
+  serializable : bool
+    run in a single serializable transaction, db.sql() must share one autocommit connection
+  retries : int
+    times to retry the transaction on serialization failure (default 3), each retry calls default and before_insert functions again
+
+indexes
+-------
+  matching looks up current rows by equality on the key fields, so each key
+  should be backed by an index (a unique one for bulk), or every upsert will
+  scan the table
 """
 
 def upsert(db, table, keys, upserts, **kwargs):
@@ -54,173 +166,492 @@ def upsert(db, table, keys, upserts, **kwargs):
                 keys[i] = tuple([key])
         return keys
 
-    def get_current(db, table, keys, kwargs):
-        """ collect current rows with a map of keys to row indexes """
+    def split_nulls(key, tups, tagged=False):
+        """ bucket key tuples by their null fields, keeping the non-null values, behind the tag when tups are (tag, tup) pairs """
+        buckets = {}
+        for tup in tups:
+            tag, tup = tup if tagged else ((), tup)
+            nulls = tuple([x for x, val in zip(key, tup) if val is None])
+            if nulls not in buckets:
+                buckets[nulls] = set()
+            buckets[nulls].add(tag + tuple([val for val in tup if val is not None]))
+        return buckets
+
+    def get_values(width, n):
+        """ placeholders for n rows of width values """
+        return ", ".join([f"({ ', '.join(['%s'] * width) })"] * n)
+
+    def get_in(fields, n):
+        """ row constructor IN clause for n tuples of fields """
+        return f"({ ', '.join(fields) }) IN ({ get_values(len(fields), n) })"
+
+    def get_probe(upserts, keys, getters, kwargs):
+        """ collect the key tuples of the upsert rows, with indexes, to match current rows against """
+        keymaps = kwargs.get("keymaps") or {}
+        nonullkeys = kwargs.get("nonullkeys")
+        # invert keymaps, from mapped values to current values
+        reverse = {}
+        for field in keymaps:
+            reverse[field] = {}
+            for k in keymaps[field]:
+                for v in keymaps[field][k]:
+                    reverse[field].setdefault(v, []).append(k)
+        plan = { key: [(key.index(field), reverse[field]) for field in reverse if field in key] for key in keys }
+        probe = {}
+        for key in keys:
+            probe[key] = set()
+            for j, upsert in enumerate(upserts):
+                tup = getters[key](upsert)
+                if nonullkeys and None in tup:
+                    continue
+                probe[key].add((j, tup))
+                # implement keymaps
+                for idx, mapping in plan[key]:
+                    for k in mapping.get(tup[idx], []):
+                        probe[key].add((j, tup[:idx] + (k,) + tup[idx + 1:]))
+        return probe
+
+    def get_matched(db, table, keys, getters, upserts, types, kwargs):
+        """ join the upsert keys against the table and collect matched rows, with indexes """
+        # the query has args, so a literal % in where is escaped for psycopg2
+        where = (kwargs.get("where") or "").replace("%", "%%")
+        probe = get_probe(upserts, keys, getters, kwargs)
+        # union the selects of all buckets into statements of up to PAGE_SIZE values
+        statements, selects, args, size = [], [], [], 0
+        for n, key in enumerate(keys):
+            # split by null fields, so the remaining fields join with = and can use an index
+            buckets = split_nulls(key, [((j,), tup) for j, tup in probe[key]], tagged=True)
+            for nulls, bucket in buckets.items():
+                fields = [x for x in key if x not in nulls]
+                cols = ["_upsert"] + [f"_k{i}" for i, _ in enumerate(fields)]
+                on = [f"{table}.{field} = u._k{i}::{types[field]}" for i, field in enumerate(fields)]
+                on += [f"{table}.{field} IS NULL" for field in nulls]
+                values = list(bucket)
+                for i in range(0, len(values), PAGE_SIZE):
+                    page = values[i:i + PAGE_SIZE]
+                    if size + len(page) > PAGE_SIZE:
+                        statements.append((selects, args))
+                        selects, args, size = [], [], 0
+                    rows = get_values(len(cols), len(page))
+                    selects.append(f"SELECT {table}.*, {table}.ctid AS _ctid, u._upsert, {n} AS _key FROM {table} JOIN (VALUES {rows}) AS u({ ', '.join(cols) }) ON { ' AND '.join(on) }{ ' WHERE (' + where + ')' if where else '' }")
+                    args += [x for row in page for x in row]
+                    size += len(page)
+        if selects:
+            statements.append((selects, args))
+
+        current, to_update = { "rows": [] }, []
+        matched = []
+        for selects, args in statements:
+            matched += db.get(" UNION ALL ".join(selects), tuple(args))
+        # order across statements, so the first key matching an upsert row is kept
+        matched.sort(key=operator.itemgetter("_upsert", "_key"))
+        indexes, seen = {}, set()
+        for row in matched:
+            ctid, j, n = row.pop("_ctid"), row.pop("_upsert"), row.pop("_key")
+            if ctid not in indexes:
+                indexes[ctid] = len(current["rows"])
+                current["rows"].append(row)
+            # a row matched on several keys or keymaps is updated once
+            if (indexes[ctid], j) not in seen:
+                seen.add((indexes[ctid], j))
+                to_update.append(Update(keys[n], indexes[ctid], j))
+        return current, to_update
+
+    def get_current(db, table, keys, getters, upserts, kwargs):
+        """ collect the keys of current rows and match them against the upsert rows, with indexes """
         where = kwargs.get("where")
-        rows = db.get(f"SELECT * FROM {table} { ' WHERE ' + where if where else '' }")
-        current = { "rows": rows, "tups": {} }
+        keymaps = kwargs.get("keymaps") or {}
+        nonullkeys = kwargs.get("nonullkeys")
+        plan = { key: [(key.index(field), keymaps[field]) for field in keymaps if field in key] for key in keys }
+        # map upsert keys to upsert indexes
+        tups = { key: defaultdict(list) for key in keys }
+        for j, upsert in enumerate(upserts):
+            for key in keys:
+                tup = getters[key](upsert)
+                if nonullkeys and None in tup:
+                    continue
+                tups[key][tup].append(j)
+        # only the keys are read, matched rows are fetched in full later
+        fields = sorted(set().union(*keys))
+        rows = db.get(f"SELECT ctid AS _ctid, { ', '.join(fields) } FROM {table} { ' WHERE ' + where if where else '' }")
+        current, to_update, seen = { "rows": rows }, [], set()
         for i, row in enumerate(rows):
             for key in keys:
-                tup = to_tup(row, key)
-                tups = [tup]
+                tup = getters[key](row)
+                alts = [tup]
                 # implement keymaps
-                for field in  kwargs.get("keymaps", {}):
-                    for k in kwargs["keymaps"][field]:
-                        idx = key.index(field)
-                        if tup[idx] == k:
-                            for v in kwargs["keymaps"][field][k]:
-                                alt = list(tup)
-                                alt[idx] = v
-                                tups.append(tuple(alt))
-                for tup in tups:
-                    if tup not in current["tups"]:
-                        current["tups"][tup] = []
-                    current["tups"][tup].append(i)
-        return current
-
-    def get_to_update(current, upserts, keys, kwargs):
-        """ iterate the upsert rows and collect matched rows, with indexes """
-        to_update = []
-        for j, upsert in enumerate(upserts):
-            for key in keys:
-                tup = to_tup(upsert, key)
-                if tup in current["tups"]:
-                    if kwargs.get("nonullkeys") and None in tup:
-                        continue
-                    for i in current["tups"][tup]:
-                        to_update.append({ "key": key, "current": i, "upsert": j })
-        return to_update
-
-    def get_default(default, row, field):
-        func = default[field][0]
+                for idx, mapping in plan[key]:
+                    for v in mapping.get(tup[idx], []):
+                        alts.append(tup[:idx] + (v,) + tup[idx + 1:])
+                for alt in alts:
+                    for j in tups[key].get(alt, []):
+                        # a row matched on several keys or keymaps is updated once
+                        if (i, j) not in seen:
+                            seen.add((i, j))
+                            to_update.append(Update(key, i, j))
+        return current, to_update
+
+    def get_full(db, table, current, to_update):
+        """ replace the key-only current rows matched for update with full rows """
+        indexes = { current["rows"][i]["_ctid"]: i for i in { x.current for x in to_update } }
+        if not indexes:
+            return
+        for row in db.get(f"SELECT *, ctid AS _ctid FROM {table} WHERE ctid = ANY(%s::tid[])", (list(indexes),)):
+            i = indexes[row.pop("_ctid")]
+            # the ctid may hold another row since the key scan, then the key-only row is kept and skipped
+            if all(row[field] == val for field, val in current["rows"][i].items() if field != "_ctid"):
+                current["rows"][i] = row
+
+    def get_call(hook):
+        """ parse a [func, *args] hook once, with getters for "*field" args taken from the row """
         args = []
-        for arg in default[field][1:]:
+        for arg in hook[1:]:
             if isinstance(arg, str) and arg.startswith("*"):
-                args.append(row[arg[1:]])
+                args.append((operator.itemgetter(arg[1:]), None))
             else:
-                args.append(arg)
-        val = func(*args)
-        return val
-
-    def do_updates(db, table, to_update, current, upserts, kwargs):
-        """ perform the updates, raise type errors and catch uniqueness violations from the table """
-        fields = db.get_fields(table)
-        ignore = kwargs.get("ignore", [])
-        fields = [x for x in fields if x not in ignore]
+                args.append((None, arg))
+        return hook[0], args
+
+    def do_call(call, row):
+        """ run a parsed hook against a row """
+        func, args = call
+        return func(*[get(row) if get else arg for get, arg in args])
+
+    def get_defaults(kwargs):
+        """ parse the default hooks, functions are still called per row as they may not be constant """
+        default = kwargs.get("default") or {}
+        return [(field, get_call(default[field])) for field in default]
+
+    def cast_upserts(upserts, types):
+        """ cast upsert values to the python types of their columns, raise type errors """
+        fields = {}
+        for field, pg_type in types.items():
+            cast = casts.get(pg_type)
+            if cast:
+                fields[field] = (cast, pg_type)
+        for upsert in upserts:
+            for field in upsert:
+                if field not in fields or upsert[field] is None:
+                    continue
+                cast, pg_type = fields[field]
+                try:
+                    upsert[field] = cast(upsert[field])
+                except (TypeError, ValueError, OverflowError, InvalidOperation):
+                    msg = f"can't perform upsert for field={field}; can't cast new={upsert[field]} {type(upsert[field])} to {pg_type}"
+                    raise TypeError(msg)
+
+    def get_update_query(table, sig, values, types, kwargs):
+        """ build a single update for a bucket of rows joined against a values list """
+        sets, key, nulls = sig
+        fields = [x for x in key if x not in nulls]
+        cols = [f"_k{i}" for i, _ in enumerate(fields)] + [f"_v{i}" for i, _ in enumerate(sets)]
+        # the query has args, so a literal % in where is escaped for psycopg2
+        where = [f"({kwargs['where'].replace('%', '%%')})"] if kwargs.get("where") else []
+        where += [f"{table}.{field} = v._k{i}::{types[field]}" for i, field in enumerate(fields)]
+        where += [f"{table}.{field} IS NULL" for field in nulls]
+        sets = [f"{field} = v._v{i}::{types[field]}" for i, field in enumerate(sets)]
+        rows = get_values(len(cols), len(values))
+        query = f"UPDATE {table} SET { ', '.join(sets) } FROM (VALUES {rows}) AS v({ ', '.join(cols) }) WHERE { ' AND '.join(where) }"
+        return query, tuple([x for row in values for x in row])
+
+    def get_prepared_update(table, sig, types, kwargs):
+        """ build a prepared update for a bucket signature, taking one array per column """
+        sets, key, nulls = sig
+        fields = [x for x in key if x not in nulls]
+        cols = [f"_k{i}" for i, _ in enumerate(fields)] + [f"_v{i}" for i, _ in enumerate(sets)]
+        # base types, a varchar(n) or numeric(p,s) array would truncate or round its elements
+        arrays = [f"{types[x]}[]" for x in fields + list(sets)]
+        where = [f"({kwargs['where']})"] if kwargs.get("where") else []
+        where += [f"{table}.{field} = v._k{i}" for i, field in enumerate(fields)]
+        where += [f"{table}.{field} IS NULL" for field in nulls]
+        sets = [f"{field} = v._v{i}" for i, field in enumerate(sets)]
+        unnest = ", ".join([f"${i + 1}::{x}" for i, x in enumerate(arrays)])
+        query = f"UPDATE {table} SET { ', '.join(sets) } FROM unnest({unnest}) AS v({ ', '.join(cols) }) WHERE { ' AND '.join(where) }"
+        name = "upsert_" + hashlib.md5(query.encode()).hexdigest()[:12]
+        statement = f"PREPARE {name} ({ ', '.join(arrays) }) AS {query}"
+        template = f"EXECUTE {name}({ ', '.join([f'%s::{x}' for x in arrays]) })"
+        return name, statement, template
+
+    def do_prepared(db, name, statement, template, args, kwargs):
+        """ execute a prepared statement, preparing it on first use by this db """
+        # a pooled connection may already hold statements from an earlier db
+        names = get_cached(prepared, db, lambda: { row["name"] for row in db.get("SELECT name FROM pg_prepared_statements") })
+        if name not in names:
+            db.sql(statement)
+            names.add(name)
+        try:
+            db.sql(template, args)
+        except psycopg2.errors.InvalidSqlStatementName:
+            # the connection was reset, e.g. by DISCARD ALL on return to a pool
+            prepared.pop(id(db), None)
+            # the transaction is aborted, let the serializable retry prepare again
+            if kwargs.get("serializable"):
+                raise
+            db.sql(statement)
+            db.sql(template, args)
+
+    def do_updates(db, execute, table, to_update, current, upserts, schema, kwargs):
+        """ perform the updates in batches, raise strict type errors and catch uniqueness violations from the table """
+        ignore = frozenset(kwargs.get("ignore", []))
+        fields = [x for x in schema["fields"] if x not in ignore]
+        types = schema["types"]
+        defaults = get_defaults(kwargs)
+        overwrite = kwargs.get("overwrite")
+        ignorenull = kwargs.get("ignorenull")
+        strict = kwargs.get("strict_types")
+        # statements can't be prepared on dryrun
+        prepare = kwargs.get("prepare") and not kwargs.get("dryrun")
+        buckets = {}
         for update in to_update:
-            rows = { "current": current["rows"][update["current"]], "upsert": upserts[update["upsert"]] }
+            rows = { "current": current["rows"][update.current], "upsert": upserts[update.upsert] }
+            # the row changed after the key scan and wasn't fetched, serializable prevents this
+            if "_ctid" in rows["current"]:
+                continue
 
             # set defaults
-            default = kwargs.get("default", {}) 
-            if default:
-                for field in default:
-                    rows["upsert"][field] = get_default(default, rows["upsert"], field)
+            for field, call in defaults:
+                rows["upsert"][field] = do_call(call, rows["upsert"])
 
             sets, args = [], []
             for field in fields:
                 cur_val = rows["current"][field]
-                if not kwargs.get("overwrite") and field not in rows["upsert"]:
+                if not overwrite and field not in rows["upsert"]:
                     continue
                 new_val = rows["upsert"].get(field)
-                if kwargs.get("ignorenull") and new_val is None:
+                if ignorenull and new_val is None:
                     continue
-                if cur_val is not None and new_val is not None and type(cur_val) != type(new_val):
+                if strict and cur_val is not None and new_val is not None and type(cur_val) != type(new_val):
                     msg = f"can't perform upsert for field={field}; types differ for new={new_val} {type(new_val)} and cur={cur_val} {type(cur_val)}"
                     raise TypeError(msg)
                 if cur_val != new_val:
-                    sets.append(f"{field} = %s")
+                    sets.append(field)
                     args.append(new_val)
             if sets:
-                where = [kwargs["where"]] if kwargs.get("where") else []
-                for field in update["key"]:
-                    val = rows["current"][field]
-                    where.append(f"{field} { 'IS' if val is None else '=' } %s")
-                    args.append(val)
-                query = f"UPDATE {table} SET { ', '.join(sets) } WHERE { ' AND '.join(where) }"
+                # bucket by fields set and key, null key fields are matched with IS NULL
+                nulls = tuple([x for x in update.key if rows["current"][x] is None])
+                vals = tuple([rows["current"][x] for x in update.key if x not in nulls])
+                sig = (tuple(sets), update.key, nulls)
+                if sig not in buckets:
+                    buckets[sig] = {}
+                # the last update to a row wins, as it would row by row
+                buckets[sig][vals] = vals + tuple(args)
+
+        for sig, bucket in buckets.items():
+            values = list(bucket.values())
+            # arrays of array columns would be flattened by unnest
+            fields = [x for x in sig[1] if x not in sig[2]] + list(sig[0])
+            if prepare and not any(types[x].endswith("[]") for x in fields):
+                name, statement, template = get_prepared_update(table, sig, types, kwargs)
+            else:
+                name = None
+            for i in range(0, len(values), PAGE_SIZE):
+                page = values[i:i + PAGE_SIZE]
+                if name:
+                    query, args = template, tuple([list(x) for x in zip(*page)])
+                else:
+                    query, args = get_update_query(table, sig, page, types, kwargs)
                 try:
-                    if kwargs.get("dryrun"):
-                        print(query, tuple(args))
+                    if name:
+                        do_prepared(db, name, statement, query, args, kwargs)
                     else:
-                        db.sql(query, tuple(args))
-                except psycopg2.errors.UniqueViolation as e:
-                    print(e)
+                        execute(query, args)
+                except psycopg2.errors.UniqueViolation:
+                    # the transaction is aborted, roll it back
+                    if kwargs.get("serializable"):
+                        raise
+                    # fall back to row by row so only the offending rows are skipped
+                    for row in page:
+                        query, args = get_update_query(table, sig, [row], types, kwargs)
+                        try:
+                            execute(query, args)
+                        except psycopg2.errors.UniqueViolation as e:
+                            print(e)
 
     def get_unmatched(to_update, current, upserts):
         """ collect unmatched rows from current and upserts """
-        indexes = { "current": set(), "upserts": set() }
-        for update in to_update:
-            indexes["current"].add(update["current"])
-            indexes["upserts"].add(update["upsert"])
-        
-        unmatched = { "current": set(), "upserts": set() }
-        for i, _ in enumerate(current["rows"]):
-            if i not in indexes["current"]:
-                unmatched["current"].add(i)
-        for i, _ in enumerate(upserts):
-            if i not in indexes["upserts"]:
-                unmatched["upserts"].add(i)
-        return unmatched
-
-    def do_inserts(db, table, unmatched, upserts, kwargs):
-        """ insert the unmatched rows, set defaults and run hooks as required """
+        matched = { "current": { x.current for x in to_update }, "upserts": { x.upsert for x in to_update } }
+        return {
+            "current": set(range(len(current["rows"]))) - matched["current"],
+            "upserts": set(range(len(upserts))) - matched["upserts"],
+        }
+
+    def get_insert_query(table, cols, values):
+        """ build a single multi-row insert for rows sharing the same columns """
+        rows = get_values(len(cols), len(values))
+        # rows violating a unique constraint are skipped
+        query = f"INSERT INTO {table} ({ ', '.join(cols) }) VALUES {rows} ON CONFLICT DO NOTHING"
+        return query, tuple([x for row in values for x in row])
+
+    def do_inserts(execute, table, unmatched, upserts, kwargs):
+        """ insert the unmatched rows in batches, set defaults and run hooks as required """
+        defaults = get_defaults(kwargs)
+        before = get_call(kwargs["before_insert"]) if kwargs.get("before_insert") else None
+        dryrun = kwargs.get("dryrun")
+        buckets = {}
         for i in unmatched["upserts"]:
             row = upserts[i]
 
             # set defaults
-            default = kwargs.get("default", {}) 
-            if default:
-                for field in default:
-                    row[field] = get_default(default, row, field)
+            for field, call in defaults:
+                row[field] = do_call(call, row)
 
             # before hook
-            before = kwargs.get("before_insert", [])
-            if before:
-                args = []
-                for arg in before[1:]:
-                    if isinstance(arg, str) and arg.startswith("*"):
-                        args.append(row[arg[1:]])
-                    else:
-                        args.append(arg)
-                if not kwargs.get("dryrun"):
-                    before[0](*args)
+            if before and not dryrun:
+                do_call(before, row)
 
-            try:
-                if kwargs.get("dryrun"):
-                    print("INSERT", row)
-                else:
-                    db.insert(row, table)
-            except psycopg2.errors.UniqueViolation as e:
-                print(e)
+            # bucket by columns, rows may carry different fields
+            cols = tuple(sorted(row))
+            if cols not in buckets:
+                buckets[cols] = []
+            buckets[cols].append(row)
 
-    def do_deletes(db, table, keys, current, unmatched, kwargs):
-        """ delete unmatched current rows """
-        for i in unmatched["current"]:
-            for key in keys:
-                row = current["rows"][i]
-                tup = to_tup(row, key)
-                where = [kwargs["where"]] if kwargs.get("where") else ["1=1"]
-                args = []
-                for field in key:
-                    val = row[field]
-                    where.append(f"{field} { 'IS' if val is None else '=' } %s")
-                    args.append(val)
-                query = f"DELETE FROM {table} WHERE { ' AND '.join(where) }"
-                if kwargs.get("dryrun"):
-                    print(query, tuple(args))
-                else:
-                    db.sql(query, tuple(args))
+        for cols, rows in buckets.items():
+            get = to_getter(cols)
+            for i in range(0, len(rows), PAGE_SIZE):
+                page = rows[i:i + PAGE_SIZE]
+                query, args = get_insert_query(table, cols, [get(row) for row in page])
+                execute(query, args)
 
-    """ process rows, do operations, and return unmatches if necessary """
-    keys = parse_keys(keys)
-    current = get_current(db, table, keys, kwargs)
-    to_update = get_to_update(current, upserts, keys, kwargs)
-    do_updates(db, table, to_update, current, upserts, kwargs)
-    unmatched = get_unmatched(to_update, current, upserts)
-    if not kwargs.get("noinsert"):
-        do_inserts(db, table, unmatched, upserts, kwargs)
-    if kwargs.get("delete"):
-        do_deletes(db, table, keys, current, unmatched, kwargs)
-    if kwargs.get("get_unmatched"):
-        return [upserts[i] for i in unmatched["upserts"]]
-    return True
+    def do_deletes(execute, table, keys, getters, current, unmatched, kwargs):
+        """ delete unmatched current rows in batches """
+        # the query has args, so a literal % in where is escaped for psycopg2
+        where = f"({kwargs['where'].replace('%', '%%')})" if kwargs.get("where") else "1=1"
+        for key in keys:
+            tups = [getters[key](current["rows"][i]) for i in unmatched["current"]]
+            # null key fields are matched with IS NULL
+            for nulls, bucket in split_nulls(key, tups).items():
+                fields = [x for x in key if x not in nulls]
+                values = list(bucket)
+                for i in range(0, len(values), PAGE_SIZE):
+                    page = values[i:i + PAGE_SIZE]
+                    terms = [where] + [f"{field} IS NULL" for field in nulls]
+                    if fields:
+                        terms.append(get_in(fields, len(page)))
+                    query = f"DELETE FROM {table} WHERE { ' AND '.join(terms) }"
+                    args = tuple([x for tup in page for x in tup])
+                    execute(query, args)
+
+    def can_bulk(keys, getters, upserts, kwargs):
+        """ check that the upsert needs none of the client-side matching """
+        if not kwargs.get("bulk") or len(keys) != 1:
+            return False
+        if any(kwargs.get(x) for x in ["where", "delete", "overwrite", "noinsert", "get_unmatched", "default", "before_insert", "keymaps"]):
+            return False
+        # null keys never conflict, so they must be matched client-side
+        return not any(None in getters[keys[0]](upsert) for upsert in upserts)
 
+    def upsert_bulk(execute, table, key, getter, upserts, types, kwargs):
+        """ upsert in batches with INSERT ... ON CONFLICT DO UPDATE against a unique index on the key """
+        ignore = frozenset(kwargs.get("ignore", []))
+        ignorenull = kwargs.get("ignorenull")
+        buckets = {}
+        for upsert in upserts:
+            cols = tuple(sorted(upsert))
+            if cols not in buckets:
+                buckets[cols] = {}
+            # a statement can't update a row twice, the last upsert wins
+            buckets[cols][getter(upsert)] = upsert
+
+        for cols, bucket in buckets.items():
+            fields = [x for x in cols if x not in key and x not in ignore]
+            if ignorenull:
+                vals = [f"COALESCE(EXCLUDED.{field}, {table}.{field})" for field in fields]
+            else:
+                vals = [f"EXCLUDED.{field}" for field in fields]
+            if fields:
+                sets = [f"{field} = {val}" for field, val in zip(fields, vals)]
+                olds = [f"{table}.{field}" for field in fields]
+                for j, field in enumerate(fields):
+                    if types.get(field, "").rstrip("[]") in no_equality:
+                        olds[j] = f"{olds[j]}::text"
+                        vals[j] = f"{vals[j]}::text"
+                # skip writes to rows which wouldn't change
+                conflict = f"DO UPDATE SET { ', '.join(sets) } WHERE ({ ', '.join(olds) }) IS DISTINCT FROM ({ ', '.join(vals) })"
+            else:
+                conflict = "DO NOTHING"
+            get = to_getter(cols)
+            rows = list(bucket.values())
+            for i in range(0, len(rows), PAGE_SIZE):
+                page = rows[i:i + PAGE_SIZE]
+                values = get_values(len(cols), len(page))
+                query = f"INSERT INTO {table} ({ ', '.join(cols) }) VALUES {values} ON CONFLICT ({ ', '.join(key) }) {conflict}"
+                args = tuple([x for row in page for x in get(row)])
+                execute(query, args)
+        return True
+
+    def do_upsert(db, table, keys, getters, upserts, schema, kwargs):
+        """ process rows, do operations, and return unmatches if necessary """
+        execute = print_sql if kwargs.get("dryrun") else db.sql
+        if can_bulk(keys, getters, upserts, kwargs):
+            return upsert_bulk(execute, table, keys[0], getters[keys[0]], upserts, schema["types"], kwargs)
+        if not kwargs.get("strict_types"):
+            cast_upserts(upserts, schema["types"])
+        if kwargs.get("delete"):
+            # deletes need to see every current row
+            current, to_update = get_current(db, table, keys, getters, upserts, kwargs)
+            get_full(db, table, current, to_update)
+        else:
+            current, to_update = get_matched(db, table, keys, getters, upserts, schema["types"], kwargs)
+        do_updates(db, execute, table, to_update, current, upserts, schema, kwargs)
+        unmatched = get_unmatched(to_update, current, upserts)
+        if not kwargs.get("noinsert"):
+            do_inserts(execute, table, unmatched, upserts, kwargs)
+        if kwargs.get("delete"):
+            do_deletes(execute, table, keys, getters, current, unmatched, kwargs)
+        if kwargs.get("get_unmatched"):
+            return [upserts[i] for i in unmatched["upserts"]]
+        return True
+
+    def ensure_indexes(db, execute, table, keys, kwargs):
+        """ create an index on each key if missing, once per db """
+        names = get_cached(ensured, db, set)
+        existing = None
+        for key in keys:
+            # hash indexes only support a single column
+            kind = "hash" if kwargs.get("index_kind") == "hash" and len(key) == 1 else "btree"
+            name = f"{table.replace('.', '_')}_{ '_'.join(key) }_upsert{ 'hash' if kind == 'hash' else '' }idx"
+            # postgres truncates names to 63 bytes, keep long ones distinct with a hash
+            if len(name.encode()) > 63:
+                name = name.encode()[:54].decode(errors="ignore") + "_" + hashlib.md5(name.encode()).hexdigest()[:8]
+            if name in names:
+                continue
+            if existing is None:
+                # fields of valid, non-partial indexes in order, expressions as nulls
+                existing = [row["fields"] for row in db.get(f"SELECT array_agg(a.attname::text ORDER BY k.n) AS fields FROM pg_index i CROSS JOIN LATERAL unnest(i.indkey::int2[]) WITH ORDINALITY AS k(attnum, n) LEFT JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = k.attnum WHERE i.indrelid = '{table}'::regclass AND i.indisvalid AND i.indpred IS NULL GROUP BY i.indexrelid")]
+            # an index leading with the key fields, like the primary key, already serves the lookups
+            if not any(set(fields[:len(key)]) == set(key) for fields in existing):
+                execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} USING {kind} ({ ', '.join(key) })")
+            if not kwargs.get("dryrun"):
+                names.add(name)
+
+    def do_transaction(db, table, keys, getters, upserts, schema, kwargs):
+        """ run the upsert in a serializable transaction, retried on serialization failures and reset prepared statements """
+        retries = kwargs.get("retries", 3)
+        for attempt in range(retries + 1):
+            db.sql("BEGIN ISOLATION LEVEL SERIALIZABLE")
+            try:
+                result = do_upsert(db, table, keys, getters, upserts, schema, kwargs)
+                db.sql("COMMIT")
+                return result
+            except (psycopg2.errors.SerializationFailure, psycopg2.errors.InvalidSqlStatementName):
+                db.sql("ROLLBACK")
+                if attempt == retries:
+                    raise
+                # exponential backoff with jitter
+                time.sleep(random.uniform(0, 0.1 * 2 ** attempt))
+            except Exception:
+                db.sql("ROLLBACK")
+                raise
+
+    """ run the upsert on a single pooled connection if the db provides one """
+    keys = parse_keys(keys)
+    getters = { key: to_getter(key) for key in keys }
+    # cached against the db itself, not the connection
+    schema = get_schema(db, table)
+    if kwargs.get("ensure_index"):
+        ensure_indexes(db, print_sql if kwargs.get("dryrun") else db.sql, table, keys, kwargs)
+    run = do_transaction if kwargs.get("serializable") and not kwargs.get("dryrun") else do_upsert
+    if kwargs.get("dryrun") or not hasattr(db, "acquire"):
+        return run(db, table, keys, getters, upserts, schema, kwargs)
+    with db.acquire() as conn:
+        return run(conn, table, keys, getters, upserts, schema, kwargs)